@@ -0,0 +1,72 @@
+import asyncio
+
+# While a batch is in flight, flush the next once it reaches this many texts or has waited this long
+EMBEDDING_BATCH_SIZE = 16
+EMBEDDING_BATCH_WAIT_SECONDS = 0.05
+
+class EmbeddingBatcher:
+    """
+    Coalesces embedding requests from concurrent webhooks into a single
+    aembed_documents call per batch.
+    """
+    def __init__(self, get_embeddings, max_batch_size: int = EMBEDDING_BATCH_SIZE,
+                 max_wait: float = EMBEDDING_BATCH_WAIT_SECONDS):
+        self.get_embeddings = get_embeddings
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = None
+        self.worker = None
+        self.pending_flushes = set()  # Keep references so in-flight flush tasks aren't garbage collected
+
+    async def embed(self, text: str):
+        """
+        Queue a text for embedding and wait for its vector.
+        """
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    def _ensure_worker(self):
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+
+            # Take whatever is already queued without waiting
+            while len(batch) < self.max_batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+
+            # While earlier batches are still in flight, keep collecting for up to max_wait;
+            # otherwise flush right away so a lone request isn't delayed by the window
+            if self.pending_flushes:
+                deadline = loop.time() + self.max_wait
+                while len(batch) < self.max_batch_size:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                    except asyncio.TimeoutError:
+                        break
+
+            task = asyncio.create_task(self._flush(batch))
+            self.pending_flushes.add(task)
+            task.add_done_callback(self.pending_flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            vectors = await self.get_embeddings().aembed_documents([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
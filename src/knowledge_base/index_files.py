@@ -0,0 +1,61 @@
+import fcntl
+import os
+
+# FAISS storage path; the combined index here predates the per-type indices below
+FAISS_INDEX_PATH = "faiss_index"
+FAISS_INDEX_FILE = os.path.join(FAISS_INDEX_PATH, "index.faiss")
+FAISS_INDEX_LOCK_FILE = FAISS_INDEX_FILE + ".lock"
+
+# Separate indices so product and conversation searches each get their own top-k
+PRODUCTS_INDEX_PATH = os.path.join(FAISS_INDEX_PATH, "products")
+CONVERSATIONS_INDEX_PATH = os.path.join(FAISS_INDEX_PATH, "conversations")
+INDEX_PATHS = (PRODUCTS_INDEX_PATH, CONVERSATIONS_INDEX_PATH)
+
+def index_file(path: str) -> str:
+    """Path of the raw FAISS index saved under an index directory."""
+    return os.path.join(path, "index.faiss")
+
+def docstore_file(path: str) -> str:
+    """Path of the pickled docstore saved under an index directory."""
+    return os.path.join(path, "index.pkl")
+
+def refine_vectors_file(path: str) -> str:
+    """Path of the full-precision vectors kept next to a compressed (PQ) index."""
+    return os.path.join(path, "vectors.npy")
+
+def split_indices_current() -> bool:
+    """
+    Check that the per-type indices are fully written and not older than the combined index.
+    FAISS.save_local writes index.pkl after index.faiss, so both must be present.
+    """
+    split_files = [f for path in INDEX_PATHS for f in (index_file(path), docstore_file(path))]
+    if not all(os.path.exists(f) for f in split_files):
+        return False
+
+    legacy_files = [f for f in (FAISS_INDEX_FILE, docstore_file(FAISS_INDEX_PATH)) if os.path.exists(f)]
+    if legacy_files:
+        return max(map(os.path.getmtime, legacy_files)) <= min(map(os.path.getmtime, split_files))
+    return True
+
+def ensure_faiss_index_exists():
+    """
+    Ensure the product and conversation FAISS indices exist and are current. If missing or
+    older than the combined index, split them out of it, or create a simple placeholder
+    when there is none.
+    """
+    os.makedirs(FAISS_INDEX_PATH, exist_ok=True)
+
+    if split_indices_current():
+        return
+
+    # Serialize index creation across worker processes sharing the same volume
+    with open(FAISS_INDEX_LOCK_FILE, "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            # Another worker may have created the indices while we waited for the lock
+            if not split_indices_current():
+                # Only the create path needs LangChain and faiss
+                from src.knowledge_base.retriever import create_faiss_indices
+                create_faiss_indices()
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
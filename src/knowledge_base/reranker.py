@@ -0,0 +1,19 @@
+import numpy as np
+import simsimd
+
+def sim(q: np.ndarray, M: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity between a query vector and each row of M, using SimSIMD kernels.
+    """
+    return 1 - np.asarray(simsimd.cdist(q[None], M, metric="cosine"))[0]
+
+def rerank(query_vector: np.ndarray, docs, doc_vectors: np.ndarray, k: int):
+    """
+    Reorder FAISS candidates by cosine similarity to the query and keep the top k.
+    """
+    if not docs:
+        return []
+
+    scores = sim(query_vector, doc_vectors)
+    order = np.argsort(-scores)[:k]
+    return [docs[i] for i in order]
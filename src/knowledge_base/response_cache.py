@@ -0,0 +1,53 @@
+from collections import OrderedDict
+import faiss
+import numpy as np
+
+# Maximum L2 distance between query embeddings for a cache hit
+RESPONSE_CACHE_THRESHOLD = 0.08
+
+# Maximum number of cached responses before the oldest is dropped
+RESPONSE_CACHE_MAX_ENTRIES = 5_000
+
+class SemanticResponseCache:
+    """
+    Cache of generated responses keyed by query embedding, so near-duplicate
+    questions can be answered without another RAG + LLM round trip.
+    """
+    def __init__(self, threshold: float = RESPONSE_CACHE_THRESHOLD, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.squared_threshold = threshold ** 2  # IndexFlatL2 reports squared distances
+        self.max_entries = max_entries
+        self.index = None  # Created on first insert, once the embedding dimension is known
+        self.responses = OrderedDict()
+        self.next_id = 0
+
+    def lookup(self, query_vector: np.ndarray):
+        """
+        Return the cached response for the nearest stored query, or None if nothing is close enough.
+        """
+        if self.index is None or self.index.ntotal == 0:
+            return None
+
+        distances, ids = self.index.search(query_vector[None], 1)
+        if ids[0][0] == -1 or distances[0][0] > self.squared_threshold:
+            return None
+        return self.responses.get(int(ids[0][0]))
+
+    def add(self, query_vector: np.ndarray, response: str):
+        """
+        Store a response under its query embedding, evicting the oldest entry when full.
+        """
+        if self.index is None:
+            self.index = faiss.IndexIDMap(faiss.IndexFlatL2(query_vector.shape[0]))
+
+        if len(self.responses) >= self.max_entries:
+            oldest_id, _ = self.responses.popitem(last=False)
+            self.index.remove_ids(np.array([oldest_id], dtype=np.int64))
+
+        entry_id = self.next_id
+        self.next_id += 1
+        self.index.add_with_ids(query_vector[None], np.array([entry_id], dtype=np.int64))
+        self.responses[entry_id] = response
+
+# Shared response cache for this process
+response_cache = SemanticResponseCache()
@@ -1,119 +1,353 @@
+import asyncio
 import os
+import pickle
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+from collections import defaultdict
+import faiss
+import numpy as np
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain.docstore.document import Document
+from src.knowledge_base.embedding_batcher import EmbeddingBatcher
+from src.knowledge_base.index_files import (
+    CONVERSATIONS_INDEX_PATH,
+    FAISS_INDEX_FILE,
+    FAISS_INDEX_PATH,
+    PRODUCTS_INDEX_PATH,
+    docstore_file,
+    ensure_faiss_index_exists,
+    index_file,
+    refine_vectors_file,
+)
+from src.knowledge_base.reranker import rerank
 
-# FAISS storage path
-FAISS_INDEX_PATH = "faiss_index"
-FAISS_INDEX_FILE = os.path.join(FAISS_INDEX_PATH, "index.faiss")
-
-def ensure_faiss_index_exists():
-    """
-    Ensure the FAISS index exists. If missing, create a simple placeholder.
-    """
-    os.makedirs(FAISS_INDEX_PATH, exist_ok=True)
-
-    if not os.path.exists(FAISS_INDEX_FILE):
-        print("⚠️ FAISS index not found. Creating a simple placeholder index.")
-        # Create some simple documents
-        documents = [
-            Document(
-                page_content="Rosemira offers organic skincare products for sensitive skin.",
-                metadata={"product": True, "title": "Gentle Cleanser", "product_type": "Cleanser"}
-            ),
-            Document(
-                page_content="Our moisturizers are fragrance-free and suitable for all skin types.",
-                metadata={"product": True, "title": "Hydrating Moisturizer", "product_type": "Moisturizer"}
-            ),
-            Document(
-                page_content="We offer free shipping on orders over $50.",
-                metadata={"conversation": True, "topic": "shipping"}
-            )
-        ]
-        
-        # Create and save a simple index
-        embeddings = OpenAIEmbeddings()
-        vector_store = FAISS.from_documents(documents, embeddings)
-        vector_store.save_local(FAISS_INDEX_PATH)
+# Number of documents retrieved from each index
+PRODUCTS_K = 3
+CONVERSATIONS_K = 2
+CONVERSATIONS_ONLY_K = 3
+
+# Process-wide cache of the loaded vector stores (by index path) and their embeddings client
+_VECTOR_STORES = {}
+_REFINE_VECTORS = {}  # Full-precision vectors for compressed indices, memory-mapped
+_EMBEDDINGS = None
+_VECTOR_STORE_LOCK = threading.RLock()
+
+# HNSW graph parameters (neighbours per node, build/search beam widths)
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# Product-quantized IVF index, used once the catalog is large enough to train it
+IVFPQ_FACTORY = "IVF256,PQ64x8"
+IVFPQ_MIN_TRAINING_VECTORS = 256 * 39
+IVFPQ_TRAINING_SAMPLE = 50_000
+IVFPQ_NPROBE = 8
+
+# Number of PQ candidates fetched before re-ranking them with full-precision vectors
+RERANK_FETCH_K = 32
+
+# Keywords indicating the user is asking for product recommendations
+RECOMMENDATION_RE = re.compile(r"recommend|suggest|product|what should i use", re.IGNORECASE)
+
+# Static parts of the response prompt
+PROMPT_HEADER = "You are a knowledgeable representative of Rosemira, a trusted provider of skincare solutions.\n\n"
+PROMPT_FOOTER = (
+    "\nBased on the user's query and any past interactions, provide a clear, concise, and informative response. "
+    "Avoid suggesting products already mentioned in the conversation."
+)
+
+def configure_search_params(index):
+    """
+    Apply query-time search parameters to a freshly built or loaded FAISS index.
+    """
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = IVFPQ_NPROBE
+        ivf.make_direct_map()  # Needed to reconstruct vectors when splitting a combined index
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+    return index
+
+def build_faiss_index(vectors: np.ndarray):
+    """
+    Build an IVFPQ index for large catalogs, or an HNSW index when there are too few vectors to train PQ.
+    """
+    if len(vectors) >= IVFPQ_MIN_TRAINING_VECTORS:
+        index = faiss.index_factory(vectors.shape[1], IVFPQ_FACTORY)
+        sample = vectors
+        if len(vectors) > IVFPQ_TRAINING_SAMPLE:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(len(vectors), IVFPQ_TRAINING_SAMPLE, replace=False)]
+        index.train(sample)
+    else:
+        index = faiss.IndexHNSWFlat(vectors.shape[1], HNSW_M)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+
+    index.add(vectors)
+    return configure_search_params(index)
+
+def build_vector_store(documents, embeddings, vectors: np.ndarray):
+    """
+    Wrap documents and their embedding vectors in a FAISS vector store.
+    """
+    index = build_faiss_index(vectors)
+
+    ids = [str(uuid.uuid4()) for _ in documents]
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, documents))),
+        index_to_docstore_id=dict(enumerate(ids))
+    )
+
+def save_split_indices(documents, vectors: np.ndarray, embeddings):
+    """
+    Split documents into products and conversations and save one FAISS index for each.
+    """
+    groups = {
+        PRODUCTS_INDEX_PATH: [i for i, doc in enumerate(documents) if "product" in doc.metadata],
+        CONVERSATIONS_INDEX_PATH: [i for i, doc in enumerate(documents) if "conversation" in doc.metadata],
+    }
+    dropped = len(documents) - len(set().union(*groups.values()))
+    if dropped:
+        print(f"⚠️ Skipping {dropped} document(s) without 'product' or 'conversation' metadata.")
+
+    for path, positions in groups.items():
+        group_docs = [documents[i] for i in positions]
+        group_vectors = vectors[positions]
+        vector_store = build_vector_store(group_docs, embeddings, group_vectors)
+
+        # Write into a fresh directory so workers that still have the old files mmapped
+        # keep a consistent index and docstore, then swap it into place
+        tmp_path = tempfile.mkdtemp(prefix=".tmp-", dir=FAISS_INDEX_PATH)
+
+        # Compressed indices keep full-precision vectors on disk for re-ranking
+        if faiss.try_extract_index_ivf(vector_store.index) is not None:
+            np.save(refine_vectors_file(tmp_path), group_vectors)
+
+        vector_store.save_local(tmp_path)
+        replace_directory(tmp_path, path)
+
+def replace_directory(src: str, dst: str):
+    """
+    Move directory src to dst, replacing any existing dst.
+    """
+    if not os.path.exists(dst):
+        os.replace(src, dst)
+        return
+
+    # rename() won't replace a non-empty directory, so move the old one aside first
+    old_path = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(dst))
+    os.replace(dst, os.path.join(old_path, "old"))
+    os.replace(src, dst)
+    shutil.rmtree(old_path)
+
+def split_legacy_index(embeddings):
+    """
+    Split the combined FAISS index into per-type indices, reusing its stored vectors.
+    """
+    legacy_store = load_vector_store(FAISS_INDEX_PATH, embeddings)
+    positions = sorted(legacy_store.index_to_docstore_id)
+    documents = [legacy_store.docstore.search(legacy_store.index_to_docstore_id[i]) for i in positions]
+    vectors = legacy_store.index.reconstruct_batch(np.array(positions, dtype=np.int64))
+    save_split_indices(documents, vectors, embeddings)
+
+def create_faiss_indices():
+    """
+    Create the per-type FAISS indices from the combined index or from placeholder documents.
+    """
+    embeddings = get_embeddings()
+
+    if os.path.exists(FAISS_INDEX_FILE):
+        print("⚠️ Per-type FAISS indices missing or stale. Splitting the combined index.")
+        split_legacy_index(embeddings)
+        return
+
+    print("⚠️ FAISS index not found. Creating a simple placeholder index.")
+    # Create some simple documents
+    documents = [
+        Document(
+            page_content="Rosemira offers organic skincare products for sensitive skin.",
+            metadata={"product": True, "title": "Gentle Cleanser", "product_type": "Cleanser"}
+        ),
+        Document(
+            page_content="Our moisturizers are fragrance-free and suitable for all skin types.",
+            metadata={"product": True, "title": "Hydrating Moisturizer", "product_type": "Moisturizer"}
+        ),
+        Document(
+            page_content="We offer free shipping on orders over $50.",
+            metadata={"conversation": True, "topic": "shipping"}
+        )
+    ]
+    
+    # Create and save simple indices
+    vectors = np.array(
+        embeddings.embed_documents([doc.page_content for doc in documents]),
+        dtype=np.float32
+    )
+    save_split_indices(documents, vectors, embeddings)
+
+def get_embeddings():
+    """
+    Return the shared OpenAI embeddings client, creating it on first use.
+    """
+    global _EMBEDDINGS
+    if _EMBEDDINGS is None:
+        with _VECTOR_STORE_LOCK:
+            if _EMBEDDINGS is None:
+                _EMBEDDINGS = OpenAIEmbeddings()
+    return _EMBEDDINGS
+
+def read_faiss_index(path: str):
+    """
+    Memory-map a FAISS index read-only so pages are loaded lazily and shared across workers.
+    IO_FLAG_MMAP maps IVF inverted lists; IO_FLAG_MMAP_IFC maps the codes of flat and HNSW indices.
+    """
+    return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+
+def load_vector_store(path: str, embeddings):
+    """
+    Load the persisted FAISS index and docstore written by FAISS.save_local.
+    """
+    index = configure_search_params(read_faiss_index(index_file(path)))
+
+    with open(docstore_file(path), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+
+    return FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id
+    )
+
+# Shared micro-batcher for query embeddings across concurrent requests
+embedding_batcher = EmbeddingBatcher(get_embeddings)
+
+def get_vector_store(path: str):
+    """
+    Return the FAISS vector store at path, loading it from disk only once per process.
+    """
+    vector_store = _VECTOR_STORES.get(path)
+    if vector_store is None:
+        embeddings = get_embeddings()
+        with _VECTOR_STORE_LOCK:
+            vector_store = _VECTOR_STORES.get(path)
+            if vector_store is None:
+                ensure_faiss_index_exists()
+                vector_store = load_vector_store(path, embeddings)
+                if os.path.exists(refine_vectors_file(path)):
+                    _REFINE_VECTORS[path] = np.load(refine_vectors_file(path), mmap_mode="r")
+                _VECTOR_STORES[path] = vector_store
+    return vector_store
+
+def fetch_candidates(vector_store, query_vector: np.ndarray, fetch_k: int):
+    """
+    Return the top FAISS candidates for a query vector along with their index positions.
+    """
+    _, positions = vector_store.index.search(query_vector[None], fetch_k)
+    positions = [int(i) for i in positions[0] if i != -1]
+
+    docs = [vector_store.docstore.search(vector_store.index_to_docstore_id[i]) for i in positions]
+    return docs, positions
+
+def search_documents(path: str, query_vector: np.ndarray, k: int):
+    """
+    Search the FAISS index at path. Uncompressed (flat/HNSW) indices already rank by L2,
+    which matches cosine order for unit-norm embeddings; compressed PQ indices over-fetch
+    and re-rank their candidates against the stored full-precision vectors.
+    """
+    vector_store = get_vector_store(path)
+    refine_vectors = _REFINE_VECTORS.get(path)
+
+    if refine_vectors is None:
+        docs, _ = fetch_candidates(vector_store, query_vector, k)
+        return docs
+
+    candidates, positions = fetch_candidates(vector_store, query_vector, max(RERANK_FETCH_K, k))
+    return rerank(query_vector, candidates, np.asarray(refine_vectors[positions]), k=k)
 
 def construct_prompt(query: str, conversations, products=None, session_state=None) -> str:
     """
     Construct a response prompt with optional product recommendations.
     """
-    prompt = (
-        "You are a knowledgeable representative of Rosemira, a trusted provider of skincare solutions.\n\n"
-        f"User Query: \"{query}\"\n\n"
-    )
+    parts = [PROMPT_HEADER, f"User Query: \"{query}\"\n\n"]
 
     # Include relevant past conversations if available
     if conversations:
-        prompt += "Relevant Past Conversations:\n"
+        parts.append("Relevant Past Conversations:\n")
         for i, conv in enumerate(conversations, 1):
-            prompt += f"{i}. {conv.page_content.strip()}\n"
+            parts.append(f"{i}. {conv.page_content.strip()}\n")
 
     # Include product recommendations if applicable
     if products and session_state:
         suggested_products = session_state.suggested_products
-        new_products = []
-
+        candidate_titles = {}
         for product in products:
-            product_title = product.metadata.get('title', 'Product Name Unknown')
-            product_type = product.metadata.get('product_type', 'Uncategorized')
+            # Keep the first occurrence of a title, as the retrieval order ranks it highest
+            candidate_titles.setdefault(
+                product.metadata.get('title', 'Product Name Unknown'),
+                product.metadata.get('product_type', 'Uncategorized')
+            )
 
-            # Only suggest new products that haven't been recommended yet
-            if product_title not in suggested_products:
-                new_products.append((product_type, product_title))
-                suggested_products.add(product_title)  # Track suggested products
+        # Only suggest new products that haven't been recommended yet
+        new_titles = candidate_titles.keys() - suggested_products
+        suggested_products |= new_titles  # Track suggested products
 
-        # Group new products by category
-        if new_products:
-            prompt += "\nRecommended Products by Category:\n"
-            category_dict = {}
-            for product_type, product_title in new_products:
-                category_dict.setdefault(product_type, []).append(product_title)
+        # Group new products by category, keeping retrieval order
+        if new_titles:
+            parts.append("\nRecommended Products by Category:\n")
+            category_dict = defaultdict(list)
+            for product_title, product_type in candidate_titles.items():
+                if product_title in new_titles:
+                    category_dict[product_type].append(product_title)
 
             for category, product_list in category_dict.items():
-                prompt += f"\n{category}:\n"
+                parts.append(f"\n{category}:\n")
                 for product in product_list:
-                    prompt += f"- {product}\n"
+                    parts.append(f"- {product}\n")
 
-    prompt += (
-        "\nBased on the user's query and any past interactions, provide a clear, concise, and informative response. "
-        "Avoid suggesting products already mentioned in the conversation."
-    )
+    parts.append(PROMPT_FOOTER)
 
-    return prompt
+    return "".join(parts)
 
-def retrieve_answer(query: str, memory, session_state) -> str:
+def is_recommendation_query(query: str) -> bool:
     """
-    Retrieves an answer to a query using FAISS.
+    Detect if the user is requesting product recommendations.
     """
-    # Ensure FAISS index is available before proceeding
-    ensure_faiss_index_exists()
+    return RECOMMENDATION_RE.search(query) is not None
 
-    # Load FAISS index safely
+async def retrieve_answer(query: str, memory, session_state, query_vector: np.ndarray = None):
+    """
+    Retrieves an answer to a query using FAISS.
+    Pass query_vector to reuse an embedding the caller already computed.
+    Returns the prompt and whether it was grounded in the knowledge base.
+    """
+    # Load FAISS indices safely (cached after the first successful load)
     try:
-        vector_store = FAISS.load_local(FAISS_INDEX_PATH, OpenAIEmbeddings(), allow_dangerous_deserialization=True)
+        get_vector_store(PRODUCTS_INDEX_PATH)
+        get_vector_store(CONVERSATIONS_INDEX_PATH)
     except Exception as e:
         print(f"❌ Error loading FAISS index: {e}")
-        return construct_prompt(query, [])  # Fallback to a simple prompt
-
-    # Perform similarity search
-    docs = vector_store.similarity_search(query, k=3)
+        return construct_prompt(query, []), False  # Fallback to a simple prompt
 
-    # Separate conversations and products
-    conversations = [doc for doc in docs if "conversation" in doc.metadata]
-    products = [doc for doc in docs if "product" in doc.metadata]
+    if query_vector is None:
+        query_vector = np.array(await embedding_batcher.embed(query), dtype=np.float32)
 
-    # Detect if the user is requesting recommendations
-    recommendation_keywords = ["recommend", "suggest", "product", "what should I use"]
-    is_recommendation_query = any(keyword in query.lower() for keyword in recommendation_keywords)
-
-    # Construct the appropriate prompt based on query intent
-    if is_recommendation_query:
-        return construct_prompt(query, conversations, products, session_state)
+    # Search the targeted indices (in parallel threads; faiss releases the GIL) and construct the prompt
+    if is_recommendation_query(query):
+        products, conversations = await asyncio.gather(
+            asyncio.to_thread(search_documents, PRODUCTS_INDEX_PATH, query_vector, PRODUCTS_K),
+            asyncio.to_thread(search_documents, CONVERSATIONS_INDEX_PATH, query_vector, CONVERSATIONS_K)
+        )
+        return construct_prompt(query, conversations, products, session_state), True
     else:
-        return construct_prompt(query, conversations)
-
-# Ensure FAISS Index Exists at Startup
-ensure_faiss_index_exists()
\ No newline at end of file
+        conversations = await asyncio.to_thread(
+            search_documents, CONVERSATIONS_INDEX_PATH, query_vector, CONVERSATIONS_ONLY_K
+        )
+        return construct_prompt(query, conversations), True
@@ -1,5 +1,8 @@
 # src/services/shopify_chat_service.py
-import requests
+import asyncio
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import httpx
 import logging
 import os
 from dotenv import load_dotenv
@@ -9,6 +12,26 @@ load_dotenv()
 
 logger = logging.getLogger(__name__)
 
+# Retry throttled or unavailable Shopify calls with exponential backoff. Posting a message
+# isn't idempotent, so 500/502/504 (where Shopify may already have accepted it) aren't retried
+RETRY_STATUSES = {429, 503}
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+
+def retry_delay(response, attempt):
+    """Seconds to wait before retrying, honoring Retry-After when Shopify sends it"""
+    retry_after = response.headers.get("Retry-After")
+    if retry_after:
+        try:
+            return max(float(retry_after), 0.0)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after)
+                return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+            except (TypeError, ValueError):
+                pass
+    return BACKOFF_FACTOR * 2 ** attempt
+
 class ShopifyChatService:
     def __init__(self):
         """Initialize Shopify Chat API client with credentials from environment variables"""
@@ -17,7 +40,18 @@ class ShopifyChatService:
         self.shop_url = os.getenv("SHOPIFY_SHOP_URL")
         self.api_version = os.getenv("SHOPIFY_API_VERSION", "2023-07")
         
-    def send_chat_response(self, conversation_id, message):
+        # Reuse connections to Shopify without blocking the event loop
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(10.0, connect=3.0),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+            transport=httpx.AsyncHTTPTransport(retries=MAX_RETRIES),  # Retries failed connects
+            headers={
+                "Content-Type": "application/json",
+                "X-Shopify-Access-Token": self.api_key
+            }
+        )
+        
+    async def send_chat_response(self, conversation_id, message):
         """
         Send a response to a Shopify chat conversation
         
@@ -33,21 +67,26 @@ class ShopifyChatService:
         # This endpoint needs to be updated based on Shopify's actual Chat API
         url = f"{self.shop_url}/api/chat/conversations/{conversation_id}/messages"
         
-        headers = {
-            "Content-Type": "application/json",
-            "X-Shopify-Access-Token": self.api_key
-        }
-        
         payload = {
             "message": message,
             "author": "bot"  # Adjust based on Shopify's API requirements
         }
         
         try:
-            response = requests.post(url, json=payload, headers=headers)
+            for attempt in range(MAX_RETRIES + 1):
+                response = await self.client.post(url, json=payload)
+                if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    break
+                logger.warning(f"Shopify returned {response.status_code}, retrying (attempt {attempt + 1})")
+                await asyncio.sleep(retry_delay(response, attempt))
+            
             response.raise_for_status()
             logger.info(f"Successfully sent message to Shopify")
             return response.json()
-        except requests.exceptions.RequestException as e:
+        except httpx.HTTPError as e:
             logger.error(f"Error sending message to Shopify: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+    
+    async def close(self):
+        """Close the underlying HTTP client and its pooled connections"""
+        await self.client.aclose()
@@ -0,0 +1,52 @@
+# src/webhook/_parsing.py
+
+# Candidate locations of each field across the payload formats we receive
+CONVERSATION_ID_PATHS = (
+    ("conversation_id",),
+    ("conversation", "id"),
+    ("data", "conversation_id"),
+    ("data", "conversation", "id"),
+)
+MESSAGE_TEXT_PATHS = (
+    ("message", "text"),
+    ("data", "message", "text"),
+    ("content",),
+    ("data", "content"),
+)
+SENDER_ID_PATHS = (
+    ("sender", "id"),
+    ("data", "sender", "id"),
+    ("author_id",),
+)
+
+def _dig(payload, path):
+    """Follow a key path through nested dicts, returning None if any step is missing"""
+    value = payload
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+        if value is None:
+            return None
+    return value
+
+def _first_present(payload, paths, default):
+    """Return the first non-empty value found at any of the given paths"""
+    for path in paths:
+        value = _dig(payload, path)
+        if value:
+            return value
+    return default
+
+def extract_conversation_id(payload):
+    """Extract conversation ID with fallbacks for different payload formats"""
+    # If not found, use a default for testing
+    return _first_present(payload, CONVERSATION_ID_PATHS, "unknown_conversation")
+
+def extract_message_text(payload):
+    """Extract message text with fallbacks for different payload formats"""
+    return _first_present(payload, MESSAGE_TEXT_PATHS, "")
+
+def extract_sender_id(payload):
+    """Extract sender ID with fallbacks"""
+    return _first_present(payload, SENDER_ID_PATHS, "unknown_sender")
@@ -1,126 +1,210 @@
 # src/webhook_api.py
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, HTTPException
 import logging
-import json
+import orjson
 import uvicorn
 import os
 import traceback
-from langchain.chains import ConversationChain
-from langchain_openai import ChatOpenAI
-from langchain.memory import ConversationBufferMemory
-from src.knowledge_base.retriever import retrieve_answer
+import numpy as np
+from cachetools import LRUCache
+from src.webhook._parsing import extract_conversation_id, extract_message_text, extract_sender_id
 
-# More verbose logging
+# Log level is configurable; set LOG_LEVEL=DEBUG to log full webhook payloads
 logging.basicConfig(
-    level=logging.DEBUG,
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Ensure the FAISS indices exist once per process at startup"""
+    from src.knowledge_base.index_files import ensure_faiss_index_exists
+    ensure_faiss_index_exists()
+    yield
+    if _redis is not None:
+        await _redis.aclose()
 
-# Store conversation memories by conversation ID
-conversation_memories = {}
+app = FastAPI(lifespan=lifespan)
 
-# Store session states by conversation ID
-session_states = {}
+# Shared chat model client, created on first use so health checks don't import LangChain
+_LLM = None
+
+def get_llm():
+    """Return the shared chat model client; short, focused replies keep generation fast"""
+    global _LLM
+    if _LLM is None:
+        from langchain_openai import ChatOpenAI
+        _LLM = ChatOpenAI(model="gpt-4o-mini", temperature=0.2, max_tokens=300)
+    return _LLM
+
+# Maximum number of conversations kept in memory before the least recently used is evicted
+MAX_TRACKED_CONVERSATIONS = int(os.environ.get("MAX_TRACKED_CONVERSATIONS", 10_000))
+
+class EvictionLoggingLRUCache(LRUCache):
+    """LRU cache that logs and counts evicted conversations"""
+    def __init__(self, maxsize, name):
+        super().__init__(maxsize=maxsize)
+        self.name = name
+        self.evictions = 0
+
+    def popitem(self):
+        key, value = super().popitem()
+        self.evictions += 1
+        logger.info(f"Evicted {self.name} for conversation {key} (total evictions: {self.evictions})")
+        return key, value
+
+# Store conversation memories by conversation ID (when Redis is not configured)
+conversation_memories = EvictionLoggingLRUCache(MAX_TRACKED_CONVERSATIONS, "conversation memory")
+
+# Store session states by conversation ID (when Redis is not configured)
+session_states = EvictionLoggingLRUCache(MAX_TRACKED_CONVERSATIONS, "session state")
 
 class WebhookSessionState:
     """Simple class to mimic Streamlit's session state for the webhook API"""
     def __init__(self):
         self.suggested_products = set()
 
+# When set, conversation state lives in Redis so every worker sees the same history
+REDIS_URL = os.environ.get("REDIS_URL")
+CONVERSATION_TTL_SECONDS = 3600
+_redis = None
+
+def get_redis():
+    """Return the shared async Redis client, connecting on first use"""
+    global _redis
+    if _redis is None:
+        import redis.asyncio as redis
+        _redis = redis.from_url(REDIS_URL)
+    return _redis
+
+def _dump_memory(memory) -> bytes:
+    """Serialize a conversation memory's messages for Redis"""
+    from langchain_core.messages import messages_to_dict
+    return orjson.dumps(messages_to_dict(memory.chat_memory.messages))
+
+def _load_memory(raw):
+    """Rebuild a conversation memory from its Redis value, or None if there is none"""
+    if raw is None:
+        return None
+
+    from langchain.memory import ConversationBufferMemory
+    from langchain_core.messages import messages_from_dict
+    memory = ConversationBufferMemory(memory_key="history", return_messages=True)
+    memory.chat_memory.add_messages(messages_from_dict(orjson.loads(raw)))
+    return memory
+
+async def load_conversation(conversation_id):
+    """Get or create the memory and session state for a conversation"""
+    from langchain.memory import ConversationBufferMemory
+
+    if REDIS_URL:
+        raw_memory, raw_products = await get_redis().mget(f"conv:{conversation_id}", f"session:{conversation_id}")
+        memory = _load_memory(raw_memory)
+        session_state = None
+        if raw_products is not None:
+            session_state = WebhookSessionState()
+            session_state.suggested_products = set(orjson.loads(raw_products))
+    else:
+        memory = conversation_memories.get(conversation_id)
+        session_state = session_states.get(conversation_id)
+
+    # Get or create memory for this conversation
+    if memory is None:
+        logger.info(f"Creating new conversation memory for {conversation_id}")
+        memory = ConversationBufferMemory(memory_key="history", return_messages=True)
+        if not REDIS_URL:
+            conversation_memories[conversation_id] = memory
+
+    # Get or create session state for this conversation
+    if session_state is None:
+        logger.info(f"Creating new session state for {conversation_id}")
+        session_state = WebhookSessionState()
+        if not REDIS_URL:
+            session_states[conversation_id] = session_state
+
+    return memory, session_state
+
+async def save_conversation(conversation_id, memory, session_state):
+    """Persist a conversation's memory and session state to Redis, if configured"""
+    if not REDIS_URL:
+        return  # The in-process caches already hold the live objects
+
+    async with get_redis().pipeline(transaction=False) as pipe:
+        pipe.set(f"conv:{conversation_id}", _dump_memory(memory), ex=CONVERSATION_TTL_SECONDS)
+        pipe.set(
+            f"session:{conversation_id}",
+            orjson.dumps(list(session_state.suggested_products)),
+            ex=CONVERSATION_TTL_SECONDS
+        )
+        await pipe.execute()
+
 @app.get("/")
 async def root():
     """Health check endpoint"""
     return {"status": "online", "service": "Rosemira Chat Bot API"}
 
-def extract_conversation_id(payload):
-    """Extract conversation ID with fallbacks for different payload formats"""
-    # Try different possible locations for the conversation ID
-    conversation_id = payload.get('conversation_id')
-    
-    if not conversation_id:
-        conversation_id = payload.get('conversation', {}).get('id')
-    
-    if not conversation_id:
-        conversation_id = payload.get('data', {}).get('conversation_id')
-    
-    if not conversation_id:
-        conversation_id = payload.get('data', {}).get('conversation', {}).get('id')
-    
-    # If still not found, use a default for testing
-    if not conversation_id:
-        conversation_id = "unknown_conversation"
-        
-    return conversation_id
-
-def extract_message_text(payload):
-    """Extract message text with fallbacks for different payload formats"""
-    # Try different possible message formats
-    message = payload.get('message', {}).get('text', '')
-    
-    if not message:
-        message = payload.get('data', {}).get('message', {}).get('text', '')
-    
-    if not message:
-        message = payload.get('content', '')
-    
-    if not message:
-        message = payload.get('data', {}).get('content', '')
-    
-    return message
-
-def extract_sender_id(payload):
-    """Extract sender ID with fallbacks"""
-    sender_id = payload.get('sender', {}).get('id')
-    
-    if not sender_id:
-        sender_id = payload.get('data', {}).get('sender', {}).get('id')
-    
-    if not sender_id:
-        sender_id = payload.get('author_id')
-    
-    if not sender_id:
-        sender_id = "unknown_sender"
-        
-    return sender_id
-
-def get_answer(query: str, memory, session_state) -> str:
+async def get_answer(query: str, memory, session_state, query_vector=None) -> str:
     """
     Generate an answer to the user's query using session-specific conversation memory.
     This mirrors the function in faq_service.py
     """
+    from langchain_core.messages import HumanMessage
+    from src.knowledge_base.response_cache import response_cache
+    from src.knowledge_base.retriever import is_recommendation_query, retrieve_answer
+
     # Retrieve the contextually constructed prompt
-    prompt = retrieve_answer(query, memory, session_state)
+    prompt, grounded = await retrieve_answer(query, memory, session_state, query_vector)
 
-    # Create the conversation chain with memory
-    conversation_chain = ConversationChain(
-        llm=ChatOpenAI(),
-        memory=memory
+    # Only opening, non-recommendation questions are context-free enough to share answers
+    # across conversations; replies depend on history and product tracking otherwise
+    use_cache = (
+        query_vector is not None
+        and not memory.chat_memory.messages
+        and not is_recommendation_query(query)
     )
 
-    # Generate a response using the conversation chain
-    response = conversation_chain.run(input=prompt)
-    return response.strip()
+    answer = response_cache.lookup(query_vector) if use_cache else None
+    if answer is not None:
+        logger.info("Semantic cache hit")
+    else:
+        # Generate a response from the conversation history plus the new prompt
+        messages = memory.chat_memory.messages + [HumanMessage(content=prompt)]
+        response = await get_llm().ainvoke(messages)
+        answer = response.content.strip()
+
+        # Don't cache answers generated from the fallback prompt
+        if use_cache and grounded:
+            response_cache.add(query_vector, answer)
+
+    # Record the exchange in the conversation memory
+    memory.save_context({"input": prompt}, {"output": answer})
+    return answer
 
 @app.post("/api/shopify-webhook")
 async def shopify_webhook(request: Request):
     """Handle incoming webhooks from Shopify"""
+    # Heavy LangChain/FAISS imports are deferred until a webhook actually arrives
+    from src.knowledge_base.retriever import embedding_batcher
+
     logger.debug("Entering shopify_webhook function")
     
     # Get the webhook payload
     try:
         # Try to get raw body first for logging
         body = await request.body()
-        logger.debug(f"Raw webhook payload: {body.decode('utf-8')}")
+        debug_enabled = logger.isEnabledFor(logging.DEBUG)
+        if debug_enabled:
+            logger.debug("Raw webhook payload: %s", body.decode('utf-8', errors='replace'))
         
         # Parse JSON
-        payload = json.loads(body)
-        logger.debug(f"Parsed webhook payload: {json.dumps(payload, indent=2)}")
-    except json.JSONDecodeError as json_error:
+        payload = orjson.loads(body)
+        if debug_enabled:
+            logger.debug("Parsed webhook payload: %s", orjson.dumps(payload).decode('utf-8'))
+    except orjson.JSONDecodeError as json_error:
         logger.error(f"JSON Decode Error: {json_error}")
-        logger.error(f"Raw payload causing error: {body.decode('utf-8')}")
+        logger.error(f"Raw payload causing error: {body.decode('utf-8', errors='replace')}")
         raise HTTPException(status_code=400, detail=f"Invalid JSON payload: {str(json_error)}")
     except Exception as e:
         logger.error(f"Unexpected error parsing payload: {e}")
@@ -141,22 +225,15 @@ async def shopify_webhook(request: Request):
         
         logger.info(f"Processing message: '{message}' from conversation {conversation_id}")
         
-        # Get or create memory for this conversation
-        if conversation_id not in conversation_memories:
-            logger.info(f"Creating new conversation memory for {conversation_id}")
-            conversation_memories[conversation_id] = ConversationBufferMemory(memory_key="history", return_messages=True)
+        memory, session_state = await load_conversation(conversation_id)
         
-        # Get or create session state for this conversation
-        if conversation_id not in session_states:
-            logger.info(f"Creating new session state for {conversation_id}")
-            session_states[conversation_id] = WebhookSessionState()
+        # Embed the message once; the vector serves both the semantic cache and retrieval
+        query_vector = np.array(await embedding_batcher.embed(message), dtype=np.float32)
         
         # Generate response using your existing RAG pipeline
-        response = get_answer(
-            message, 
-            conversation_memories[conversation_id], 
-            session_states[conversation_id]
-        )
+        response = await get_answer(message, memory, session_state, query_vector)
+        
+        await save_conversation(conversation_id, memory, session_state)
         
         # Log the response
         logger.info(f"Generated response: {response}")
@@ -167,7 +244,7 @@ async def shopify_webhook(request: Request):
             "query": message,
             "response": response,
             "conversation_id": conversation_id,
-            "suggested_products": list(session_states[conversation_id].suggested_products)
+            "suggested_products": list(session_state.suggested_products)
         }
         
     except Exception as e:
@@ -176,4 +253,4 @@ async def shopify_webhook(request: Request):
         raise HTTPException(status_code=500, detail=str(e))
 
 if __name__ == "__main__":
-    uvicorn.run("webhook_api:app", host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file
+    uvicorn.run("src.webhook_api:app", host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
\ No newline at end of file